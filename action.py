@@ -1,17 +1,35 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import functools
+import hashlib
+import http.client
 import json
 import os
 import platform
+import random
 import re
+import shlex
+import shutil
 import subprocess
 import time
 import urllib
-import urllib.request
+import urllib.parse
 from multiprocessing.pool import ThreadPool
 
-build_actions_root = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
+# orjson parses and serializes several times faster than the stdlib json
+# module, but it's purely optional - fall back to stdlib when not installed.
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# Deferred and cached so that merely importing the module (--help, tooling)
+# doesn't pay for path resolution.
+@functools.lru_cache(maxsize=None)
+def build_actions_root():
+  return os.path.dirname(os.path.abspath(__file__))
 
 
 # Constants & Features
@@ -30,10 +48,28 @@ apt_llvm_gpg_file_url = "https://apt.llvm.org/llvm-snapshot.gpg.key"
 apt_ubuntu_test_toolchain_ppa = "ppa:ubuntu-toolchain-r/test"
 
 # Retry when apt-get fails with the following message (happens on CI occasionally).
+# Let apt retry transient download failures itself before we restart the
+# whole subprocess through run()'s retry loop.
+apt_get_options = ["-o", "Acquire::Retries=3", "-o", "Acquire::http::Timeout=30"]
+
+# A CI compile never needs the Recommends closure (docs, examples, locales),
+# and --force-unsafe-io spares dpkg its per-file fsync on ephemeral VMs.
+apt_install_options = [
+  "--no-install-recommends",
+  "-o", "Dpkg::Use-Pty=0",
+  "-o", "Dpkg::Options::=--force-unsafe-io"
+]
+
+# Fingerprint of the last successfully installed package set - used to skip
+# the whole apt sequence on persistent runners (see prepare_linux).
+apt_stamp_file = "/var/cache/build-actions/apt.stamp"
+
 apt_retry_patterns = [
   "Connection timed out",
+  "Could not resolve",
   "Internal Server Error",
-  "Gateway Time-out"
+  "Gateway Time-out",
+  "Temporary failure"
 ]
 
 problem_matcher_definitions = {
@@ -72,12 +108,26 @@ architecture_vs_platform_map = {
   "aarch64": "ARM64"
 }
 
+compiler_vs_generator_map = {
+  "vs2015": "Visual Studio 14 2015",
+  "vs2017": "Visual Studio 15 2017",
+  "vs2019": "Visual Studio 16 2019",
+  "vs2022": "Visual Studio 17 2022"
+}
+
+unix_makefiles_hosts = frozenset(["Darwin", "FreeBSD", "NetBSD", "OpenBSD"])
+
 
 # Common Utilities
 # ----------------
 
 
-log_options = { "groups": False }
+log_options = {
+  "groups": False,
+  # Setting BUILD_ACTIONS_VERBOSE=0 disables command echoing, which also
+  # skips building the command-line string for very long cmake invocations.
+  "commands": os.getenv("BUILD_ACTIONS_VERBOSE", "1").lower() not in ("0", "false", "off")
+}
 
 def log(message):
   print(message, flush=True)
@@ -95,19 +145,20 @@ def pluralize(s, count):
     return s
   return s + "s"
 
+def strip_quotes(value):
+  if value.startswith('"') and value.endswith('"'):
+    return value[1:len(value)-1]
+  return value
+
+# Multi-line so the whole content can be scanned by the regex engine in one
+# pass without splitting and stripping individual lines in Python.
+key_value_re = re.compile("(?m)^[ \\t]*(\\w+)[ \\t]*=[ \\t]*(.*?)[ \\t\\r]*$")
+
 def parse_key_value_data(content):
   d = {}
-  r = re.compile("^(\\w+)\\s*=\\s*(.*)$")
-
-  for line in content.split("\n"):
-    line = line.strip()
-    m = r.match(line)
-    if m:
-      key = m[1]
-      value = m[2]
-      if value.startswith('"') and value.endswith('"'):
-          value = value[1:len(value)-1]
-      d[key] = value
+
+  for m in key_value_re.finditer(content):
+    d[m[1]] = strip_quotes(m[2])
 
   return d
 
@@ -124,6 +175,10 @@ def read_text_file(file_name):
     return f.read()
 
 def read_json_file(file_name):
+  if orjson:
+    with open(file_name, "rb") as f:
+      return orjson.loads(f.read())
+
   with open(file_name, "r", encoding="utf-8") as f:
     return json.load(f)
 
@@ -132,17 +187,80 @@ def write_text_file(file_name, data):
     f.write(data)
 
 def write_json_file(file_name, data):
+  if orjson:
+    with open(file_name, "wb") as f:
+      f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    return
+
   with open(file_name, "w", encoding="utf-8") as f:
     json.dump(data, f, indent=2)
 
-def download_text_file(url, method="GET", encoding="utf-8", max_attempts=3):
+# Keep-alive connections indexed by (scheme, host) so consecutive downloads
+# from the same host (e.g. LLVM repository check + GPG key) reuse a single
+# TCP/TLS session instead of paying the handshake cost twice.
+http_connections = {}
+
+def http_connection(scheme, host):
+  key = (scheme, host)
+  conn = http_connections.get(key)
+  if conn is None:
+    if scheme == "https":
+      conn = http.client.HTTPSConnection(host)
+    else:
+      conn = http.client.HTTPConnection(host)
+    http_connections[key] = conn
+  return conn
+
+def close_http_connection(scheme, host):
+  conn = http_connections.pop((scheme, host), None)
+  if conn:
+    conn.close()
+
+def http_request(parts, method, path):
+  try:
+    conn = http_connection(parts.scheme, parts.netloc)
+    conn.request(method, path, headers={"Connection": "keep-alive"})
+    return conn.getresponse()
+  except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+    # The server closed the pooled keep-alive connection in the meantime.
+    # That's not a download failure - reconnect and retry immediately.
+    close_http_connection(parts.scheme, parts.netloc)
+    conn = http_connection(parts.scheme, parts.netloc)
+    conn.request(method, path, headers={"Connection": "keep-alive"})
+    return conn.getresponse()
+
+def download_text_file(url, method="GET", encoding="utf-8", max_attempts=3, max_redirects=5):
   for attempt in range(max_attempts):
+    target = url
+    parts = urllib.parse.urlsplit(target)
+
     try:
-      req = urllib.request.Request(url=url, method=method)
-      with urllib.request.urlopen(req) as f:
-        return f.read().decode(encoding)
+      for _ in range(max_redirects + 1):
+        parts = urllib.parse.urlsplit(target)
+        path = parts.path or "/"
+        if parts.query:
+          path += "?" + parts.query
+
+        response = http_request(parts, method, path)
+        # The body must be read even when not used, otherwise the connection
+        # cannot be reused for the next request.
+        data = response.read()
+
+        location = response.getheader("Location")
+        if 300 <= response.status < 400 and location:
+          target = urllib.parse.urljoin(target, location)
+          continue
+
+        # A non-2xx response means the content is not what was asked for.
+        if response.status >= 300:
+          raise ValueError("HTTP status {} ({})".format(response.status, response.reason))
+
+        return data.decode(encoding)
+
+      raise ValueError("Too many redirects (url={})".format(url))
     except BaseException as e:
       log("WARNING: Failed to download a file: {}".format(e))
+      close_http_connection(parts.scheme, parts.netloc)
 
       if attempt < max_attempts - 1:
         time.sleep(5)
@@ -150,72 +268,80 @@ def download_text_file(url, method="GET", encoding="utf-8", max_attempts=3):
       return None
 
 globals = {
-  "sudo": None
+  "os_release": None,
+  "apt_updated": False
 }
 
+@functools.lru_cache(maxsize=None)
 def has_sudo():
-  if globals["sudo"] is None:
-    try:
-      subprocess.run(["sudo", "--version"], check=True)
-      globals["sudo"] = True
-    except:
-      globals["sudo"] = False
-  return globals["sudo"]
-
-def stringify_args(args):
-  processed = []
-  for arg in args:
-    if " " in arg:
-      processed.append('"' + arg + '"')
-    else:
-      processed.append(arg)
-  return " ".join(processed)
-
-def decode_stdout_stderr(result, encoding):
-  out = result.stdout.decode(encoding)
-  err = result.stderr.decode(encoding)
-  return (out, err)
+  try:
+    subprocess.run(["sudo", "--version"], check=True)
+    return True
+  except:
+    return False
 
-def run(args, cwd=None, env=None, check=True, input=None, sudo=False, print_command=True, retry_patterns=None, retry_count=3):
+def run(args, cwd=None, env=None, check=True, input=None, sudo=False, print_command=True,
+        retry_patterns=None, retry_count=3, retry_min=0.2, retry_max=8.0, retry_rate=2.0):
   encoding = "utf-8"
 
   if sudo and has_sudo():
     args = ["sudo"] + args
 
-  if input:
-    input = input.encode(encoding)
-
+  print_command = print_command and log_options["commands"]
   if print_command:
-    log(stringify_args(args))
+    # shlex.join produces shell-safe quoting and runs at C speed.
+    log(shlex.join(args))
+
+  if not retry_patterns:
+    # Fast path - no retry matching is needed, so don't capture anything and
+    # let the child write directly to our stdout/stderr.
+    return subprocess.run(args, cwd=cwd, env=env, input=input, check=check,
+                          text=True, encoding=encoding, errors="replace")
 
   retry_count = max(retry_count, 1)
 
   for i in range(retry_count):
-    try:
-      result = subprocess.run(args, cwd=cwd, env=env, input=input, check=check, capture_output=True)
-      out, err = decode_stdout_stderr(result, encoding)
-      print(out)
-      print(err)
-      return result
-    except subprocess.CalledProcessError as e:
-      out, err = decode_stdout_stderr(e, encoding)
-      retry_pattern_matched = None
-
-      if retry_patterns:
-        for retry_pattern in retry_patterns:
-          if retry_pattern in out or retry_pattern in err:
-            retry_pattern_matched = retry_pattern
-            break
-
-      if retry_pattern_matched and i < retry_count - 1:
-        if print_command:
-          log("Retrying command because of '{}' error (retry pattern matched)".format(retry_pattern_matched))
-        time.sleep(1)
-        continue
-
-      print(out)
-      print(err)
-      raise e
+    proc = subprocess.Popen(
+      args, cwd=cwd, env=env,
+      stdin=subprocess.PIPE if input is not None else None,
+      stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+      bufsize=1, text=True, encoding=encoding, errors="replace")
+
+    if input is not None:
+      proc.stdin.write(input)
+      proc.stdin.close()
+
+    # Stream the output line by line instead of buffering everything - a build
+    # can produce megabytes of output. Only a bounded tail is retained for
+    # retry pattern matching.
+    tail = collections.deque(maxlen=2048)
+
+    for line in proc.stdout:
+      print(line, end="", flush=True)
+      tail.append(line)
+
+    returncode = proc.wait()
+
+    if returncode == 0 or not check:
+      return subprocess.CompletedProcess(args, returncode)
+
+    retry_pattern_matched = None
+    for retry_pattern in retry_patterns:
+      if any(retry_pattern in line for line in tail):
+        retry_pattern_matched = retry_pattern
+        break
+
+    if retry_pattern_matched and i < retry_count - 1:
+      if print_command:
+        log("Retrying command because of '{}' error (retry pattern matched)".format(retry_pattern_matched))
+      # Exponential backoff with jitter - the first retry fires quickly in
+      # case the failure was a blip, later ones wait out a real outage, and
+      # the jitter keeps concurrent runners from retrying in lockstep.
+      delay = min(retry_max, retry_min * (retry_rate ** i))
+      time.sleep(delay + random.uniform(0, delay))
+      continue
+
+    raise subprocess.CalledProcessError(returncode, args)
 
 def run_test(args):
   try:
@@ -225,21 +351,28 @@ def run_test(args):
     return False
 
 
+
 # Host OS & Architecture Utilities
 # --------------------------------
 
 
-host_os = platform.system()
+# Deferred and cached - platform.system() can be surprisingly expensive on
+# some platforms and isn't needed for argument introspection.
+@functools.lru_cache(maxsize=None)
+def host_os():
+  return platform.system()
 
 def is_root():
   return os.geteuid() == 0
 
+@functools.lru_cache(maxsize=None)
 def cpu_count():
   try:
     return len(os.sched_getaffinity(0))
   except:
     return os.cpu_count()
 
+@functools.lru_cache(maxsize=None)
 def detect_architecture():
   return "x64"
 
@@ -250,6 +383,11 @@ def normalize_architecture(arch):
   return arch
 
 def os_release_info():
+  # Cache the parsed content as it never changes and this function is called
+  # multiple times during the 'prepare' step.
+  if globals["os_release"] is not None:
+    return globals["os_release"]
+
   out = {
     "id": "",
     "name": "",
@@ -257,23 +395,26 @@ def os_release_info():
     "unstable": False
   }
 
-  if host_os == "Linux":
+  if host_os() == "Linux":
     try:
-      obj = parse_key_value_data(read_text_file("/etc/os-release"))
-
-      for k, v in obj.items():
-        if k == "ID":
-          out["id"] = v
-        elif k == "NAME":
-          out["name"] = v
-        elif k == "VERSION_CODENAME":
-          out["codename"] = v
-        elif k == "PRETTY_NAME":
+      # Only four keys are interesting, so match them directly instead of
+      # running the general-purpose key/value parser on the whole file.
+      for line in read_text_file("/etc/os-release").splitlines():
+        line = line.strip()
+        if line.startswith("ID="):
+          out["id"] = strip_quotes(line[3:])
+        elif line.startswith("NAME="):
+          out["name"] = strip_quotes(line[5:])
+        elif line.startswith("VERSION_CODENAME="):
+          out["codename"] = strip_quotes(line[17:])
+        elif line.startswith("PRETTY_NAME="):
+          v = strip_quotes(line[12:])
           if v.endswith("/sid") or v.endswith("/testing"):
             out["unstable"] = True
     except:
       pass
 
+  globals["os_release"] = out
   return out
 
 
@@ -288,12 +429,9 @@ def is_compiler_clang(compiler):
   return compiler.startswith("clang")
 
 def compiler_version(compiler):
-  if compiler.startswith("gcc-"):
-    return compiler[4:]
-
-  if compiler.startswith("clang-"):
-    return compiler[6:]
-
+  for prefix in ("gcc-", "clang-"):
+    if compiler.startswith(prefix):
+      return compiler[len(prefix):]
   return ""
 
 def match_compiler_versions(compiler, versions):
@@ -306,32 +444,44 @@ def c_compiler_executable(compiler):
   else:
     raise ValueError("Invalid compiler: {}".format(compiler))
 
+@functools.lru_cache(maxsize=None)
 def cpp_compiler_executable(compiler):
+  # Rewrite only the prefix - replace() would rewrite every occurrence.
   if is_compiler_gcc(compiler):
-    return compiler.replace("gcc", "g++")
+    return "g++" + compiler[3:]
   elif is_compiler_clang(compiler):
-    return compiler.replace("clang", "clang++")
+    return "clang++" + compiler[5:]
   else:
     raise ValueError("Invalid compiler: {}".format(compiler))
 
+@functools.lru_cache(maxsize=None)
 def analyze_build_executable(compiler):
-  return compiler.replace("clang", "analyze-build")
+  return "analyze-build" + compiler[5:]
 
+# Presence-only checks use shutil.which - a PATH scan answers the question
+# without spawning a subprocess. Probes where the exit code matters (can the
+# compiler actually run?) still go through run_test. Either way the results
+# are cached, so each tool is probed at most once per process.
+
+@functools.lru_cache(maxsize=None)
 def cmake_exists():
-  return run_test(["cmake", "--version"])
+  return shutil.which("cmake") is not None
 
+@functools.lru_cache(maxsize=None)
 def ninja_exists():
-  return run_test(["ninja", "--version"])
+  return shutil.which("ninja") is not None
 
+@functools.lru_cache(maxsize=None)
 def valgrind_exists():
-  return run_test(["valgrind", "--version"])
+  return shutil.which("valgrind") is not None
 
-def c_compiler_exists(compiler):
+@functools.lru_cache(maxsize=None)
+def compiler_pair_exists(compiler):
+  # The C++ driver is co-installed with the C driver by every gcc/clang
+  # package we care about, so a single probe of the C driver covers both.
   return run_test([c_compiler_executable(compiler), "--version"])
 
-def cpp_compiler_exists(compiler):
-  return run_test([cpp_compiler_executable(compiler), "--version"])
-
+@functools.lru_cache(maxsize=None)
 def analyze_build_exists(compiler):
   return run_test([analyze_build_executable(compiler), "--help"])
 
@@ -379,17 +529,70 @@ def process_problem_matchers(problem_matcher, diagnostics):
   return out
 
 def begin_problem_matchers(problem_matchers, scope):
+  lines = []
   for pm in problem_matchers:
     info = problem_matcher_definitions[pm]
     if info["scope"] == scope:
-      log("::add-matcher::" + os.path.join(build_actions_root, "problem-matcher-{}.json".format(pm)))
+      lines.append("::add-matcher::" + os.path.join(build_actions_root(), "problem-matcher-{}.json".format(pm)))
+  if lines:
+    log("\n".join(lines))
 
 def end_problem_matchers(problem_matchers, scope):
+  lines = []
   for pm in problem_matchers:
     info = problem_matcher_definitions[pm]
     if info["scope"] == scope:
       for item in info["provides"]:
-        log("::remove-matcher owner={}::".format(item))
+        lines.append("::remove-matcher owner={}::".format(item))
+  if lines:
+    log("\n".join(lines))
+
+
+# CMake Compiler-Check Cache
+# --------------------------
+
+
+# A fresh build directory makes cmake redo its compiler identification and ABI
+# checks every run. Those results only depend on the toolchain, so they are
+# cached under the user cache directory keyed by compiler, compiler version,
+# generator, architecture, and build definitions.
+cmake_user_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "build-actions", "cmake")
+
+def cmake_cache_key(cc, generator, architecture, build_defs):
+  try:
+    cc_version = subprocess.run([cc, "--version"], check=True, capture_output=True, text=True, encoding="utf-8").stdout
+  except:
+    return None
+  data = "\n".join([cc, cc_version, generator, architecture, build_defs or ""])
+  return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def cmake_version_dirs(cmake_files_dir):
+  # CMake keeps its compiler checks in 'CMakeFiles/<cmake-version>/'.
+  try:
+    return [e for e in os.scandir(cmake_files_dir) if e.is_dir() and e.name[0].isdigit()]
+  except OSError:
+    return []
+
+def cmake_restore_compiler_checks(key, build_dir):
+  for entry in cmake_version_dirs(os.path.join(cmake_user_cache_dir, key)):
+    target = os.path.join(build_dir, "CMakeFiles", entry.name)
+    if not os.path.isdir(target):
+      log("Restoring cached cmake compiler checks ({})".format(entry.name))
+      try:
+        shutil.copytree(entry.path, target)
+      except OSError:
+        pass
+
+def cmake_store_compiler_checks(key, build_dir):
+  cache_dir = os.path.join(cmake_user_cache_dir, key)
+  for entry in cmake_version_dirs(os.path.join(build_dir, "CMakeFiles")):
+    target = os.path.join(cache_dir, entry.name)
+    if not os.path.isdir(target):
+      try:
+        os.makedirs(cache_dir, exist_ok=True)
+        shutil.copytree(entry.path, target)
+      except OSError:
+        pass
 
 
 # Prepare & Configure Utilities
@@ -415,19 +618,33 @@ def normalize_arguments(args):
     args.diagnostics = "analyze-build"
 
   if not args.generator:
-    if args.compiler == "vs2015":
-      args.generator = "Visual Studio 14 2015"
-    elif args.compiler == "vs2017":
-      args.generator = "Visual Studio 15 2017"
-    elif args.compiler == "vs2019":
-      args.generator = "Visual Studio 16 2019"
-    elif args.compiler == "vs2022":
-      args.generator = "Visual Studio 17 2022"
-    elif host_os == "Darwin" or host_os == "FreeBSD" or host_os == "NetBSD" or host_os == "OpenBSD":
+    if args.compiler in compiler_vs_generator_map:
+      args.generator = compiler_vs_generator_map[args.compiler]
+    elif host_os() in unix_makefiles_hosts:
       args.generator = "Unix Makefiles"
     else:
       args.generator = "Ninja"
 
+  # Classify the compiler and generator once - later steps read these fields
+  # instead of repeating the same startswith checks.
+  if is_compiler_gcc(args.compiler):
+    args.compiler_family = "gcc"
+  elif is_compiler_clang(args.compiler):
+    args.compiler_family = "clang"
+  elif args.compiler in compiler_vs_generator_map:
+    args.compiler_family = "vs"
+  else:
+    args.compiler_family = ""
+
+  args.generator_is_vs = args.generator.startswith("Visual Studio")
+
+  if args.compiler_family == "gcc" or args.compiler_family == "clang":
+    args.cc_bin = c_compiler_executable(args.compiler)
+    args.cxx_bin = cpp_compiler_executable(args.compiler)
+  else:
+    args.cc_bin = ""
+    args.cxx_bin = ""
+
   args.problem_matcher = process_problem_matchers(args.problem_matcher, args.diagnostics)
 
 
@@ -498,158 +715,246 @@ def apt_add_llvm_toolchain_repository(version):
     write_text_file("llvm.sources", sources_data)
     # We need to run this as root as we need to change files in /etc.
     run(["mv", "llvm.sources", "/etc/apt/sources.list.d/llvm.sources"], sudo=True)
+
+    apt_update()
   else:
     log("!! Failure !!")
     raise ValueError("Failed to get a distribution codename, cannot continue")
 
+def apt_ppa_configured(ppa):
+  # 'ppa:ubuntu-toolchain-r/test' materializes as files starting with
+  # 'ubuntu-toolchain-r' in /etc/apt/sources.list.d.
+  prefix = ppa.split(":", 1)[-1].split("/", 1)[0]
+  try:
+    return any(f.startswith(prefix) for f in os.listdir("/etc/apt/sources.list.d"))
+  except OSError:
+    return False
+
 def apt_add_test_ubuntu_toolchain():
-  run(["add-apt-repository", "-y", apt_ubuntu_test_toolchain_ppa], sudo=True)
+  # On a warm runner the PPA is typically configured already, and re-adding
+  # it would re-parse sources and invoke gpg for nothing.
+  if apt_ppa_configured(apt_ubuntu_test_toolchain_ppa):
+    log("PPA {} is already configured".format(apt_ubuntu_test_toolchain_ppa))
+    return
 
+  # --no-update suppresses the implicit 'apt-get update' - the indexes are
+  # refreshed exactly once afterwards by apt_update().
+  run(["add-apt-repository", "-y", "--no-update", apt_ubuntu_test_toolchain_ppa], sudo=True)
 
-# Prepare Step
-# ------------
+def apt_update():
+  run(["apt-get", "update", "-qq"] + apt_get_options, sudo=True, retry_patterns=apt_retry_patterns)
+  globals["apt_updated"] = True
 
-def prepare_step(args):
-  """
-  Prepare step is responsible for configuring the environment for the
-  selected compiler, generator, and diagnostic options.
-
-  NOTE: Prepare only configures the environment, but it doesn't create or use build
-  directory. This is the main reason why some parameters must be repeatedly passed
-  to the 'configure' step.
-  """
+def dpkg_package_installed(package):
+  try:
+    result = subprocess.run(
+      ["dpkg-query", "-W", "-f=${Status}", package],
+      check=True, capture_output=True, text=True, encoding="utf-8")
+    return "install ok installed" in result.stdout
+  except:
+    return False
 
-  begin_group("Prepare")
+def apt_stamp_key(packages):
+  return hashlib.sha256(repr(sorted(packages)).encode("utf-8")).hexdigest()
 
-  compiler = args.compiler
-  generator = args.generator
+def apt_read_stamp():
+  try:
+    return read_text_file(apt_stamp_file).strip()
+  except OSError:
+    return ""
 
-  # Windows Support
-  # ---------------
+def apt_write_stamp(key):
+  # The stamp lives in /var/cache, so use the same write-and-move-as-root
+  # approach as the LLVM sources file.
+  write_text_file("apt.stamp", key + "\n")
+  run(["mkdir", "-p", os.path.dirname(apt_stamp_file)], sudo=True)
+  run(["mv", "apt.stamp", apt_stamp_file], sudo=True)
 
-  if host_os == "Windows":
-    pass
 
-  # Apple Support
-  # -------------
+# Prepare Step
+# ------------
 
-  elif host_os == "Darwin":
-    pass
+# Windows Support
+# ---------------
 
-  # BSD Support
-  # -----------
+def prepare_windows(args):
+  pass
 
-  elif host_os == "FreeBSD":
-    packages = []
+# Apple Support
+# -------------
 
-    if not cmake_exists():
-      packages.append("cmake")
+def prepare_darwin(args):
+  pass
 
-    if is_compiler_clang(compiler):
-      if not run_test([compiler, "--version"]):
-        if compiler == "clang":
-          if not run_test(["clang", "--version"]):
-            packages.append("llvm")
-        else:
-          if not run_test([compiler, "--version"]):
-            packages.append(compiler.replace("clang-", "llvm"))
-    else:
-      raise ValueError("{} compiler not supported: use clang on this platform".format(compiler))
+# BSD Support
+# -----------
 
-    if packages:
-      log("Need to install {} packages".format(packages))
-      run(["pkg", "install", "-y"] + packages, sudo=not is_root())
+def prepare_freebsd(args):
+  compiler = args.compiler
+  packages = []
 
-  elif host_os == "NetBSD":
-    packages = []
+  if args.compiler_family != "clang":
+    raise ValueError("{} compiler not supported: use clang on this platform".format(compiler))
 
-    if not cmake_exists():
-      packages.append("cmake")
+  if not cmake_exists():
+    packages.append("cmake")
 
-    if compiler.startswith("clang"):
-      if not run_test([compiler, "--version"]):
-        packages.append(compiler)
+  if shutil.which(compiler) is None:
+    if compiler == "clang":
+      packages.append("llvm")
     else:
-      raise ValueError("{} compiler not supported: use clang on this platform".format(compiler))
+      packages.append(compiler.replace("clang-", "llvm"))
 
-    if packages:
-      log("Need to install {} packages".format(packages))
-      if os.getenv("CI_NETBSD_USE_PKGIN"):
-        run(["pkgin", "-y", "install"] + packages, sudo=not is_root())
-      else:
-        run(["pkg_add", "-I"] + packages, sudo=not is_root())
+  if packages:
+    log("Need to install {} packages".format(packages))
+    run(["pkg", "install", "-y"] + packages, sudo=not is_root())
+
+def prepare_netbsd(args):
+  compiler = args.compiler
+  packages = []
 
-  elif host_os == "OpenBSD":
-    packages = []
+  if not compiler.startswith("clang"):
+    raise ValueError("{} compiler not supported: use clang on this platform".format(compiler))
 
-    if not cmake_exists():
-      packages.append("cmake")
+  if not cmake_exists():
+    packages.append("cmake")
 
-    if compiler.startswith("clang"):
-      if not run_test([compiler, "--version"]):
-        packages.append(compiler)
-    else:
-      raise ValueError("{} compiler not supported: use clang on this platform".format(compiler))
+  if shutil.which(compiler) is None:
+    packages.append(compiler)
 
-    if packages:
-      log("Need to install {} packages".format(packages))
+  if packages:
+    log("Need to install {} packages".format(packages))
+    if os.getenv("CI_NETBSD_USE_PKGIN"):
+      run(["pkgin", "-y", "install"] + packages, sudo=not is_root())
+    else:
       run(["pkg_add", "-I"] + packages, sudo=not is_root())
 
-  # Linux Support
-  # -------------
+def prepare_openbsd(args):
+  compiler = args.compiler
+  packages = []
 
-  elif host_os == "Linux":
-    packages = []
-    compiler_package = None
+  if not compiler.startswith("clang"):
+    raise ValueError("{} compiler not supported: use clang on this platform".format(compiler))
 
-    if is_compiler_gcc(compiler):
-      compiler_package = compiler.replace("gcc", "g++")
-    elif is_compiler_clang(compiler):
-      compiler_package = compiler
-    else:
-      raise ValueError("Invalid compiler: {}".format(compiler))
+  if not cmake_exists():
+    packages.append("cmake")
 
-    compiler_exists = c_compiler_exists(compiler) and cpp_compiler_exists(compiler)
-    if not compiler_exists:
-      packages.append(compiler_package)
+  if shutil.which(compiler) is None:
+    packages.append(compiler)
 
-    if args.architecture == "x86":
-      run(["dpkg", "--add-architecture", "i386"], sudo=True)
-      packages.append("linux-libc-dev:i386")
-      if is_compiler_gcc(compiler):
-        packages.append(compiler_package + "-multilib")
-      else:
-        # Even clang requires this if libstdc++ is used.
-        packages.append("g++-multilib")
+  if packages:
+    log("Need to install {} packages".format(packages))
+    run(["pkg_add", "-I"] + packages, sudo=not is_root())
 
-    if not cmake_exists():
-      packages.append("cmake")
+# Linux Support
+# -------------
 
-    if generator == "Ninja" and not ninja_exists():
-      packages.append("ninja-build")
+def prepare_linux(args):
+  compiler = args.compiler
+  generator = args.generator
 
-    if args.diagnostics == "valgrind" and not valgrind_exists():
-      packages.append("valgrind")
+  packages = []
+  compiler_package = None
 
-    if args.diagnostics == "analyze-build" and not analyze_build_exists(compiler):
-      if not is_compiler_clang(compiler):
-        raise ValueError("analyze-build can only be used with clang compiler, not {}".format(compiler))
-      packages.append(compiler.replace("clang", "clang-tools"))
+  if args.compiler_family == "gcc":
+    # The g++ package pulls in the matching gcc one.
+    compiler_package = args.cxx_bin
+  elif args.compiler_family == "clang":
+    compiler_package = compiler
+  else:
+    raise ValueError("Invalid compiler: {}".format(compiler))
 
-    if packages:
-      log("Need to install {} packages".format(packages))
+  compiler_exists = compiler_pair_exists(compiler)
+  if not compiler_exists:
+    packages.append(compiler_package)
 
-      if compiler.startswith("clang-") and not compiler_exists and match_compiler_versions(compiler, apt_llvm_versions):
-        apt_add_llvm_toolchain_repository(compiler_version(compiler))
-      elif os_release_info()["id"] == "ubuntu":
-        apt_add_test_ubuntu_toolchain()
+  if args.architecture == "x86":
+    run(["dpkg", "--add-architecture", "i386"], sudo=True)
+    packages.append("linux-libc-dev:i386")
+    if args.compiler_family == "gcc":
+      packages.append(compiler_package + "-multilib")
+    else:
+      # Even clang requires this if libstdc++ is used.
+      packages.append("g++-multilib")
+
+  if not cmake_exists():
+    packages.append("cmake")
+
+  if generator == "Ninja" and not ninja_exists():
+    packages.append("ninja-build")
+
+  if args.diagnostics == "valgrind" and not valgrind_exists():
+    packages.append("valgrind")
+
+  if args.diagnostics == "analyze-build" and not analyze_build_exists(compiler):
+    if args.compiler_family != "clang":
+      raise ValueError("analyze-build can only be used with clang compiler, not {}".format(compiler))
+    packages.append(compiler.replace("clang", "clang-tools"))
+
+  # Deduplicate while keeping order - e.g. 'gcc' with x86 architecture would
+  # otherwise list g++-multilib twice, and every listed package costs apt a
+  # resolver pass.
+  packages = list(dict.fromkeys(packages))
+
+  if packages:
+    # A persistent runner may have installed exactly this package set in a
+    # previous run - in that case skip the whole apt sequence.
+    stamp_key = apt_stamp_key(packages)
+    if apt_read_stamp() == stamp_key:
+      log("Skipping installation of {} packages (apt stamp matches)".format(packages))
+      return
+
+    # Also drop packages the runner already has, so apt resolves only what
+    # is actually missing.
+    packages = [package for package in packages if not dpkg_package_installed(package)]
+
+  if packages:
+    log("Need to install {} packages".format(packages))
+
+    if compiler.startswith("clang-") and not compiler_exists and match_compiler_versions(compiler, apt_llvm_versions):
+      apt_add_llvm_toolchain_repository(compiler_version(compiler))
+    elif os_release_info()["id"] == "ubuntu":
+      apt_add_test_ubuntu_toolchain()
+
+    if not globals["apt_updated"]:
+      apt_update()
+
+    # dpkg spends a lot of its time in fsync/fdatasync calls, which are
+    # pointless on an ephemeral CI VM - eatmydata turns them into no-ops.
+    # This is purely an optimization, so a failed bootstrap must never fail
+    # the prepare step - just install without the prefix in that case.
+    if shutil.which("eatmydata") is None:
+      run(["apt-get", "install", "-qq"] + apt_get_options + apt_install_options + ["eatmydata"], sudo=True, check=False, retry_patterns=apt_retry_patterns)
+
+    install_prefix = ["eatmydata"] if shutil.which("eatmydata") else []
+    run(install_prefix + ["apt-get", "install", "-qq"] + apt_get_options + apt_install_options + packages, sudo=True, retry_patterns=apt_retry_patterns)
+    apt_write_stamp(stamp_key)
+
+def prepare_unknown(args):
+  raise ValueError("Unknown platform: {}".format(host_os()))
+
+# The handler is selected by host OS, which never changes within a process.
+prepare_handlers = {
+  "Windows": prepare_windows,
+  "Darwin" : prepare_darwin,
+  "FreeBSD": prepare_freebsd,
+  "NetBSD" : prepare_netbsd,
+  "OpenBSD": prepare_openbsd,
+  "Linux"  : prepare_linux
+}
 
-      run(["apt-get", "update", "-qq"], sudo=True, retry_patterns=apt_retry_patterns)
-      run(["apt-get", "install", "-qq"] + packages, sudo=True, retry_patterns=apt_retry_patterns)
+def prepare_step(args):
+  """
+  Prepare step is responsible for configuring the environment for the
+  selected compiler, generator, and diagnostic options.
 
-  else:
-    raise ValueError("Unknown platform: {}".format(host_os))
+  NOTE: Prepare only configures the environment, but it doesn't create or use build
+  directory. This is the main reason why some parameters must be repeatedly passed
+  to the 'configure' step.
+  """
 
+  begin_group("Prepare")
+  prepare_handlers.get(host_os(), prepare_unknown)(args)
   end_group("Prepare")
 
 
@@ -686,7 +991,10 @@ def configure_step(args):
     actions_config = {}
 
   cmd = ["cmake", source_dir, "-G", generator]
-  env = os.environ.copy()
+
+  # Environment variables to add on top of os.environ - the full environment
+  # is only materialized when there is actually something to override.
+  env_overlay = {}
 
   cmake_c_flags = []
   cmake_cxx_flags = []
@@ -704,11 +1012,13 @@ def configure_step(args):
       else:
         cmake_extra_flags.append(flag)
 
-  if generator.startswith("Visual Studio"):
+  if args.generator_is_vs:
     cmd.extend(["-A", architecture_vs_platform_map[args.architecture]])
   else:
-    env["CC"] = c_compiler_executable(compiler)
-    env["CXX"] = cpp_compiler_executable(compiler)
+    if not args.cc_bin:
+      raise ValueError("Invalid compiler: {}".format(compiler))
+    env_overlay["CC"] = args.cc_bin
+    env_overlay["CXX"] = args.cxx_bin
 
     if args.architecture == "x86":
       cmake_c_flags.append("-m32")
@@ -721,7 +1031,7 @@ def configure_step(args):
       cmake_cxx_flags.extend(hardened_flags)
 
     if link_flags:
-      env["LDFLAGS"] = " ".join(link_flags)
+      env_overlay["LDFLAGS"] = " ".join(link_flags)
 
     if args.build_type:
       cmd.append("-DCMAKE_BUILD_TYPE=" + args.build_type)
@@ -743,8 +1053,19 @@ def configure_step(args):
 
   # Create build directory and invoke cmake.
   os.makedirs(build_dir, exist_ok=True)
+
+  cache_key = None
+  if not args.generator_is_vs:
+    cache_key = cmake_cache_key(args.cc_bin, generator, args.architecture, args.build_defs)
+    if cache_key:
+      cmake_restore_compiler_checks(cache_key, build_dir)
+
+  env = {**os.environ, **env_overlay} if env_overlay else None
   run(cmd, cwd=build_dir, env=env, print_command=True)
 
+  if cache_key:
+    cmake_store_compiler_checks(cache_key, build_dir)
+
   actions_config["build"] = {
     "build_tool": "cmake",
     "build_type": args.build_type,
@@ -761,17 +1082,22 @@ def configure_step(args):
 
   end_group("Configure")
 
+  # Returned so subsequent steps running in the same process ('all') don't
+  # have to read the configuration back from disk.
+  return actions_config
+
 
 # Build Step
 # ----------
 
 
-def build_step(args):
+def build_step(args, actions_config=None):
   """
   Build step is responsible for building a previously configured project.
   """
 
-  actions_config = read_json_file(os.path.join(args.build_dir, actions_config_name))
+  if actions_config is None:
+    actions_config = read_json_file(os.path.join(args.build_dir, actions_config_name))
   build_dir = args.build_dir
   generator = actions_config["build"]["generator"]
   build_type = actions_config["build"]["build_type"]
@@ -816,21 +1142,21 @@ class TestCase:
     self.stderr = ""
 
   def execute(self):
-    result = subprocess.run(self.cmd, cwd=self.cwd, capture_output=True)
-    out, err = decode_stdout_stderr(result, "utf-8")
-    self.stdout = out
-    self.stderr = err
+    result = subprocess.run(self.cmd, cwd=self.cwd, capture_output=True, text=True, encoding="utf-8", errors="replace")
+    self.stdout = result.stdout
+    self.stderr = result.stderr
     self.returncode = result.returncode
 
 def execute_test(test_case):
   test_case.execute()
 
-def test_step(args):
+def test_step(args, actions_config=None):
   """
   Test step is responsible for executing all tests and to fail if any test fails.
   """
 
-  actions_config = read_json_file(os.path.join(args.build_dir, actions_config_name))
+  if actions_config is None:
+    actions_config = read_json_file(os.path.join(args.build_dir, actions_config_name))
   build_dir = args.build_dir
   build_type = actions_config["build"]["build_type"]
 
@@ -838,6 +1164,10 @@ def test_step(args):
   if build_type and os.path.isdir(os.path.join(build_dir, build_type)):
     build_dir = os.path.join(build_dir, build_type)
 
+  # Resolved once - os.path.abspath() queries the current directory on
+  # every call, so don't do that per test.
+  build_dir = os.path.abspath(build_dir)
+
   tests = actions_config.get("tests", [])
 
   if not tests:
@@ -845,26 +1175,56 @@ def test_step(args):
 
   begin_problem_matchers(args.problem_matcher, "run")
 
-  pool = ThreadPool()
+  diagnostics = actions_config["build"]["diagnostics"]
+
+  is_windows = host_os() == "Windows"
+  exe_suffix = ".exe" if is_windows else ""
+
+  if diagnostics == "valgrind":
+    valgrind_prefix = ["valgrind"] + actions_config.get("valgrind_arguments", default_valgrind_arguments)
+  else:
+    valgrind_prefix = None
+
+  # Tests run concurrently up to the core count; valgrind is memory-hungry
+  # and effectively serializes the machine anyway, so don't overlap it.
+  pool = ThreadPool(1 if valgrind_prefix else cpu_count())
   test_cases = []
   n_failures = 0
 
+  # Read the build directory once instead of issuing a stat() per test. On
+  # POSIX also require the executable bit, so a broken build artifact fails
+  # here instead of in a doomed exec attempt.
+  try:
+    if is_windows:
+      built_files = set(e.name for e in os.scandir(build_dir) if e.is_file())
+    else:
+      built_files = set(e.name for e in os.scandir(build_dir) if e.is_file() and e.stat().st_mode & 0o111)
+  except OSError:
+    built_files = set()
+
   for test in tests:
     cmd = test["cmd"]
     app = cmd[0]
     id = " ".join(cmd)
 
-    executable = os.path.abspath(os.path.join(build_dir, app))
-    if host_os == "Windows":
-      executable += ".exe"
+    file_name = app + exe_suffix
+
+    # Tests nested in a subdirectory are not covered by the scan.
+    if "/" in file_name or os.sep in file_name:
+      try:
+        st = os.stat(os.path.join(build_dir, file_name))
+        exists = is_windows or bool(st.st_mode & 0o111)
+      except OSError:
+        exists = False
+    else:
+      exists = file_name in built_files
 
     # Ignore tests, which were not built, because of disabled features.
-    if os.path.isfile(executable):
-      cmd[0] = executable
+    if exists:
+      cmd[0] = os.path.join(build_dir, file_name)
 
-      if actions_config["build"]["diagnostics"] == "valgrind":
-        valgrind_arguments = actions_config.get("valgrind_arguments", default_valgrind_arguments)
-        cmd = ["valgrind"] + valgrind_arguments + cmd
+      if valgrind_prefix:
+        cmd = valgrind_prefix + cmd
 
       test_case = TestCase(id=id, cmd=cmd, cwd=build_dir)
       test_cases.append(test_case)
@@ -934,7 +1294,7 @@ def create_argument_parser():
 
   return parser
 
-def execute_step(step, args):
+def execute_step(step, args, actions_config=None):
   if step == "prepare":
     return prepare_step(args)
 
@@ -942,10 +1302,10 @@ def execute_step(step, args):
     return configure_step(args)
 
   if step == "build":
-    return build_step(args)
+    return build_step(args, actions_config)
 
   if step == "test":
-    return test_step(args)
+    return test_step(args, actions_config)
 
   raise ValueError("Unknown step: {}".format(step))
 
@@ -958,9 +1318,9 @@ def main():
   if step == "all":
     log_options["groups"] = True
     execute_step("prepare", args)
-    execute_step("configure", args)
-    execute_step("build", args)
-    execute_step("test", args)
+    actions_config = execute_step("configure", args)
+    execute_step("build", args, actions_config)
+    execute_step("test", args, actions_config)
   else:
     execute_step(step, args)
 